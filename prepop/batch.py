@@ -1,13 +1,29 @@
 """Utilities for batch loading/unloading of fixtures, see design.md"""
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.db import models
 from django.db import transaction
+from django.db.models import BooleanField
+from django.db.models import ExpressionWrapper
+from django.db.models import Q
 from django.utils.module_loading import import_string
 
 from .core import UnresolvedFixtureError
 from .core import AbstractStorageFixture
+from .core import ModelFixture
+from .core import memoize_existing_objects
+from .walk import walks_on_trees, copy_tree, TraversalTerminator
 
 import logging
 logger = logging.getLogger('portal')
 
+# max number of fixtures per bulk INSERT
+BULK_BATCH_SIZE = 500
+# max number of fixtures per bulk existence query, each adds a column to it
+EXISTENCE_BATCH_SIZE = 100
+
 
 def unpack_fixture_modules(module_paths):
     batch = []
@@ -16,36 +32,337 @@ def unpack_fixture_modules(module_paths):
         assert all(isinstance(f, AbstractStorageFixture) for f in fixtures)
         batch += fixtures
 
-    return batch
+    return _intern_fixtures(batch)
+
+
+def _intern_fixtures(fixtures):
+    """Replaces structurally equal fixtures, in the batch and in fixture data,
+    by a single instance so that each is resolved (and e.g. looked up in db)
+    only once per batch. Fixtures with unhashable data are left alone."""
+    canonical = {}  # (fixture class, data) -> fixture
+    interned = {}   # id(fixture) -> canonical fixture
+
+    @walks_on_trees
+    def intern_in_data(value):
+        if isinstance(value, AbstractStorageFixture):
+            return TraversalTerminator(intern(value))
+
+    def intern(fixture):
+        if id(fixture) in interned:
+            return interned[id(fixture)]
+
+        fixture.data = intern_in_data(fixture.data)
+        key = (type(fixture), tuple((k, type(v), v) for k, v in sorted(fixture.data.items())))
+        try:
+            result = canonical.setdefault(key, fixture)
+        except TypeError:
+            result = fixture
+
+        interned[id(fixture)] = result
+        return result
 
+    return [intern(fixture) for fixture in fixtures]
 
-@transaction.atomic()
+
+@transaction.atomic(savepoint=False)
 def load_fixtures(fixtures):
-    """Loads a sequence of fixtures in a transaction. Returns an integer retcode."""
+    """Loads a sequence of fixtures in a transaction. Returns an integer retcode.
+
+    Model fixtures of classes with bulk_loadable set are collected and checked
+    for existence and created in bulk. As far as fixtures can tell, the order
+    of loading is unchanged: pending bulk creations are flushed before any
+    fixture is resolved whose resolution may query the db for them, and
+    before any other fixture is loaded.
+
+    Where the db backend allows it, foreign key checks are disabled while
+    loading and all loaded tables are checked once at the end instead.
+    """
     assert all(isinstance(f, AbstractStorageFixture) for f in fixtures)
 
+    disabled = connection.disable_constraint_checking()
+    try:
+        with memoize_existing_objects():
+            retcode = _load_fixtures(fixtures)
+    finally:
+        if disabled:
+            connection.enable_constraint_checking()
+
+    if disabled:
+        connection.check_constraints(table_names=_table_names(fixtures))
+
+    return retcode
+
+
+def _load_fixtures(fixtures):
+    pending = _BulkLoad()
     for fixture in fixtures:
+        if pending.add(fixture):
+            continue
+
+        pending.flush()
         try:
             fixture.load()
         except UnresolvedFixtureError as e:
             logger.info('Failed to resolve %s due to missing dependency: %s' % (fixture, e.args[0]))
             return 1
 
+    pending.flush()
     return 0
 
 
-@transaction.atomic()
+@transaction.atomic(savepoint=False)
 def unload_fixtures(fixtures):
     """Unloads a sequence of fixtures in a transaction. Returns an integer retcode."""
     assert all(isinstance(f, AbstractStorageFixture) for f in fixtures)
 
+    with memoize_existing_objects():
+        return _unload_fixtures(fixtures)
+
+
+def _unload_fixtures(fixtures):
     # Important: trigger data resolution of all fixtures *before* starting to
     # unload. Without this we might run into unresolvable fixtures half way
     # through because we just unloaded a dependency.
     for fixture in fixtures:
         fixture.attempt_data_resolution()
 
+    # look up existing objects of bulk loadable model fixtures in bulk, so
+    # that unload() doesn't need a query per fixture to know if it exists.
+    groups = defaultdict(lambda: defaultdict(list))
+    for fixture in fixtures:
+        identity = _bulk_identity(fixture)
+        if identity is not None:
+            groups[(fixture.model, tuple(fixture.identifying_fields))][identity].append(fixture)
+
+    for (model, identifying_fields), by_identity in groups.items():
+        existing = _existing_objects(model, identifying_fields, by_identity)
+        for identity, group in by_identity.items():
+            objs = existing.get(identity, [])
+            for fixture in group:
+                if len(objs) > 1:
+                    # ambiguous, let unload() look it up like any other fixture
+                    fixture._forget_existing_object()
+                else:
+                    fixture._set_existing_object(objs[0] if objs else None)
+
     for fixture in fixtures:
         fixture.unload()
 
     return 0
+
+
+class _BulkLoad:
+    """Model fixtures waiting to be loaded in bulk, see load_fixtures()."""
+    def __init__(self):
+        # (model, identifying fields) -> identity -> fixtures, where identity
+        # is the tuple of normalized identifying values, see _identity().
+        self.groups = defaultdict(lambda: defaultdict(list))
+        # pending models and their parents, i.e. tables with pending rows
+        self.models = set()
+        # fixture -> what resolving it may query, see _dependencies()
+        self.dependencies = {}
+
+    def may_be_observed_by(self, fixture):
+        """Returns True if resolving fixture may query the db for pending
+        objects, i.e. if it or a fixture in its data (transitively) has field
+        resolvers, or if such a fixture is not a model fixture or is one of a
+        pending model."""
+        if not self.models:
+            return False
+
+        opaque, models = self._dependencies(fixture)
+        return opaque or not self.models.isdisjoint(models)
+
+    def _dependencies(self, fixture):
+        # returns (opaque, models) where opaque is True if resolving fixture
+        # may run arbitrary queries, and models are those (with parents) that
+        # it may query otherwise. Memoized, each fixture's data is walked once.
+        if fixture in self.dependencies:
+            return self.dependencies[fixture]
+
+        # guards against cycles in fixture data
+        self.dependencies[fixture] = (False, frozenset())
+
+        opaque = bool(fixture._field_resolvers_map())
+        models = set()
+        for nested in _nested_fixtures(fixture.data):
+            # its resolve_self() is called
+            if not isinstance(nested, ModelFixture):
+                opaque = True
+            else:
+                models.update(_model_and_parents(nested.model))
+            nested_opaque, nested_models = self._dependencies(nested)
+            opaque = opaque or nested_opaque
+            models.update(nested_models)
+
+        result = self.dependencies[fixture] = (opaque, frozenset(models))
+        return result
+
+    def add(self, fixture):
+        """Adds fixture to pending fixtures if it can be loaded in bulk,
+        returns a boolean indicating whether it was added. Flushes pending
+        fixtures first if resolving fixture may depend on them."""
+        if not _allows_bulk(fixture):
+            return False
+
+        if self.may_be_observed_by(fixture):
+            self.flush()
+
+        identity = _bulk_identity(fixture)
+        if identity is None:
+            return False
+
+        if not fixture.resolvable:
+            # let load() decide whether it exists or is an error
+            return False
+
+        if not fixture._m2m_field_names().isdisjoint(fixture.resolved_data):
+            return False
+
+        key = (fixture.model, tuple(fixture.identifying_fields))
+        self.groups[key][identity].append(fixture)
+        self.models.update(_model_and_parents(fixture.model))
+        return True
+
+    def flush(self):
+        for (model, identifying_fields), by_identity in self.groups.items():
+            _bulk_load(model, identifying_fields, by_identity)
+
+        self.groups.clear()
+        self.models.clear()
+
+
+def _table_names(fixtures):
+    # tables that model fixtures may have written to, including m2m tables
+    table_names = set()
+    for model in {f.model for f in fixtures if isinstance(f, ModelFixture)}:
+        table_names.add(model._meta.db_table)
+        for field in model._meta.local_many_to_many:
+            table_names.add(field.remote_field.through._meta.db_table)
+
+    return sorted(table_names)
+
+
+def _model_and_parents(model):
+    return {model, *model._meta.get_parent_list()}
+
+
+def _nested_fixtures(data):
+    # returns all fixtures in data, not descending into them
+    found = []
+
+    @walks_on_trees
+    def find(value):
+        if isinstance(value, AbstractStorageFixture):
+            found.append(value)
+            return TraversalTerminator(value)
+
+    find(data)
+    return found
+
+
+def _allows_bulk(fixture):
+    # bulk_create() does not support multi-table inheritance
+    return (
+        isinstance(fixture, ModelFixture)
+        and fixture.bulk_loadable
+        and bool(fixture.identifying_fields)
+        and not fixture.model._meta.parents
+    )
+
+
+def _bulk_identity(fixture):
+    # returns the identity of a fixture that allows bulk operations, or None.
+    # Resolves the fixture's data.
+    if not _allows_bulk(fixture):
+        return None
+
+    values = [fixture.resolved_data[k] for k in fixture.identifying_fields]
+    if fixture.find_unresolvable_dependency(values):
+        return None
+
+    try:
+        identity = _identity(fixture.model, fixture.identifying_fields, values)
+        hash(identity)
+    except (TypeError, ValidationError):
+        return None
+
+    return identity
+
+
+def _identity(model, identifying_fields, values):
+    # normalizes identifying values so that those of fixtures and of objects
+    # in db can be compared, e.g. FKs become the values of their target field.
+    identity = []
+    for name, value in zip(identifying_fields, values):
+        field = model._meta.get_field(name)
+        if field.is_relation:
+            field = field.target_field
+            if isinstance(value, models.Model):
+                value = getattr(value, field.attname)
+        identity.append(field.to_python(value))
+
+    return tuple(identity)
+
+
+def _existing_objects(model, identifying_fields, identities):
+    # returns a dict mapping identities to lists of matching objects in db.
+    # Matching is left to the db, whose comparison semantics (collations,
+    # padding, time zones) python can't reproduce: each row is annotated
+    # with one boolean per identity.
+    identities = list(identities)
+    existing = defaultdict(list)
+    for i in range(0, len(identities), EXISTENCE_BATCH_SIZE):
+        chunk = identities[i:i + EXISTENCE_BATCH_SIZE]
+        query = Q()
+        matches = {}
+        for j, identity in enumerate(chunk):
+            lookup = Q(**dict(zip(identifying_fields, identity)))
+            query |= lookup
+            matches['_prepop_match_%d' % j] = ExpressionWrapper(lookup, output_field=BooleanField())
+
+        for obj in model.objects.filter(query).annotate(**matches):
+            for j, identity in enumerate(chunk):
+                if obj.__dict__.pop('_prepop_match_%d' % j):
+                    existing[identity].append(obj)
+
+    return existing
+
+
+def _bulk_load(model, identifying_fields, by_identity):
+    # by_identity maps identities to fixtures identifying the same object,
+    # only the first of which is created if the object does not exist.
+    existing = _existing_objects(model, identifying_fields, by_identity)
+    to_create = []
+    for identity, fixtures in by_identity.items():
+        objs = existing.get(identity, [])
+        if len(objs) == 1:
+            for fixture in fixtures:
+                logger.debug('Fixture already exists, nothing to load: %s' % fixture)
+                fixture._set_existing_object(objs[0])
+            continue
+
+        if objs:
+            # ambiguous, let load() handle it like any other fixture
+            for fixture in fixtures:
+                fixture._forget_existing_object()
+                fixture.load()
+            continue
+
+        logger.debug('Creating fixture: %s' % fixtures[0])
+        # copy nested values, model code may modify them in place
+        obj = model(**{k: copy_tree(v) for k, v in fixtures[0].resolved_data.items()})
+        obj.full_clean(validate_unique=False)
+        to_create.append((obj, fixtures))
+
+    model.objects.bulk_create([obj for obj, _ in to_create], batch_size=BULK_BATCH_SIZE)
+
+    for obj, fixtures in to_create:
+        logger.debug('Loaded fixture: %s' % fixtures[0])
+        for fixture in fixtures:
+            # some db backends don't set primary keys in bulk_create(), in
+            # which case existing_object() has to look the object up.
+            if obj.pk is not None:
+                fixture._set_existing_object(obj)
+            else:
+                fixture._forget_existing_object()
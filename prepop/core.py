@@ -1,13 +1,27 @@
 """Core implementation of Fixture API, see design.md"""
+import functools
 from abc import ABC
 from abc import abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
 
-from .walk import walks_on_trees, TraversalTerminator
+from .walk import walks_on_trees, copy_tree, TraversalTerminator
 
 import logging
 logger = logging.getLogger('portal')
 
 
+_SENTINEL = object()
+
+# all subclasses of AbstractStorageFixture, for cheap type checks on every node
+# of fixture data, see AbstractStorageFixture.__init_subclass__.
+_FIXTURE_TYPES = set()
+
+# fixture -> memoized result of ModelFixture.existing_object(), only set for
+# the duration of memoize_existing_objects().
+_existing_objects_memo = ContextVar('existing_objects_memo', default=None)
+
+
 class UnresolvedFixtureError(Exception):
     """Raised when there are unexpected UnresolvableFixture instances."""
     pass
@@ -42,10 +56,16 @@ class AbstractStorageFixture(ABC):
                             dependencies are resolvable.
         * resolved_data     contents of self.data after data resolution
                             it might contain instances of UnresolvableFixture.
+                            It may share nested lists and dicts with
+                            self.data, don't modify those in place.
 
     Fixture clients are discouraged from relying on the internal API.
     """
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        _FIXTURE_TYPES.add(cls)
+
     def __init__(self, **data):
         self.data = data
 
@@ -113,62 +133,118 @@ class AbstractStorageFixture(ABC):
             * (happy path) directly access the resolved_data property.
             * (delicate path, not for clients) call attempt_data_resolution().
         """
-        self._resolved_data = self._resolve_fixtures_in_data(self.data)
-        self._unresolvable_dep = self.find_unresolvable_dependency(self._resolved_data)
+        unresolvable_deps = []
+        if self._needs_deep_resolve(self.data):
+            self._resolved_data = self._resolve_fixtures_in_data(self.data, unresolvable_deps)
+        else:
+            # fast path for the common case of flat data with no fixtures
+            self._resolved_data = self.data
+        if self._resolved_data is self.data:
+            # nothing was resolved, copy self.data so that field resolvers
+            # below don't modify it. Nested values are copied below.
+            self._resolved_data = dict(self.data)
+        self._unresolvable_dep = unresolvable_deps[0] if unresolvable_deps else None
         if self._unresolvable_dep:
             # Field resolvers expect properly resolved values, don't bother
             # with them if we have unresolvable dependencies
             return
 
-        for field, resolver in self._get_field_resolvers().items():
+        for field, resolver_name in type(self)._field_resolvers_map().items():
             if field in self._resolved_data:
-                self._resolved_data[field] = resolver(self._resolved_data[field])
+                resolver = getattr(self, resolver_name)
+                # resolved data may share lists and dicts with self.data, see
+                # walks_on_trees, give resolvers a copy they can modify.
+                value = copy_tree(self._resolved_data[field])
+                self._resolved_data[field] = resolver(value)
 
     @staticmethod
-    @walks_on_trees
-    def _resolve_fixtures_in_data(value):
-        # - not a module function to keep scope clean.
-        # - @staticmethod for signature to comply with @walks_on_trees.
-        if isinstance(value, AbstractStorageFixture):
-            resolved = value.resolve_self()
-
-            if isinstance(resolved, AbstractStorageFixture):
-                raise FixtureProgrammingError(
-                    'Fixture %s resolved to another fixture %s' % (value, resolved)
-                )
-            return TraversalTerminator(resolved)
+    def _needs_deep_resolve(data):
+        # shallow scan, True if any value is a container or a fixture
+        for value in data.values():
+            cls = type(value)
+            if cls in _FIXTURE_TYPES or cls is UnresolvableFixture:
+                return True
+            if isinstance(value, (list, dict)):
+                return True
 
-    def _get_field_resolvers(self):
-        # unpack field resolvers, see @register_field_resolver
+        return False
+
+    @staticmethod
+    def _resolve_fixtures_in_data(data, unresolvable_deps):
+        # Returns a copy of data with all fixtures resolved. Unresolvable
+        # dependencies are appended to unresolvable_deps, in traversal order,
+        # which spares us a second walk via find_unresolvable_dependency().
+        @walks_on_trees
+        def resolve(value):
+            if type(value) is UnresolvableFixture:
+                unresolvable_deps.append(value.fixture)
+                return TraversalTerminator(value)
+
+            if type(value) in _FIXTURE_TYPES:
+                resolved = value.resolve_self()
+
+                if type(resolved) in _FIXTURE_TYPES:
+                    raise FixtureProgrammingError(
+                        'Fixture %s resolved to another fixture %s' % (value, resolved)
+                    )
+                if type(resolved) is UnresolvableFixture:
+                    unresolvable_deps.append(resolved.fixture)
+                elif isinstance(resolved, (list, dict)):
+                    # resolve_self() may return containers of resolved values
+                    dep = AbstractStorageFixture.find_unresolvable_dependency(resolved)
+                    if dep is not None:
+                        unresolvable_deps.append(dep)
+                return TraversalTerminator(resolved)
+
+        return resolve(data)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _field_resolvers_map(cls):
+        # unpack field resolvers, see @register_field_resolver. Maps field
+        # names to attribute names (not bound methods) so that it can be
+        # cached per class. Inspects class dicts directly instead of dir() and
+        # getattr() to avoid evaluating properties.
         resolvers = {}
-        for attr in dir(self):
-            value = getattr(self, attr)
-            field_name = getattr(value, '_registered_field_resolver_for', None)
-            if callable(value) and field_name is not None:
-                resolvers[field_name] = value
+        seen = set()
+        for klass in cls.__mro__:
+            for attr, value in vars(klass).items():
+                if attr in seen:
+                    # overridden in a subclass
+                    continue
+                seen.add(attr)
+                if isinstance(value, (staticmethod, classmethod)):
+                    value = value.__func__
+                field_name = getattr(value, '_registered_field_resolver_for', None)
+                if callable(value) and field_name is not None:
+                    resolvers.setdefault(field_name, attr)
 
         return resolvers
 
     # ========= Helpers for internal use ========
     @classmethod
     def find_unresolvable_dependency(cls, resolved_data):
-        # returns the first unresolvable fixture, or None.
-        @walks_on_trees
-        def raise_if_unresolved(value):
-            if isinstance(value, UnresolvableFixture):
-                raise UnresolvedFixtureError(value.fixture)
-
-            if isinstance(value, AbstractStorageFixture):
+        # returns the first unresolvable fixture, or None. Equivalent to a
+        # walk with @walks_on_trees but stops early and builds no copies.
+        stack = [resolved_data]
+        while stack:
+            value = stack.pop()
+            if type(value) is UnresolvableFixture:
+                return value.fixture
+
+            if type(value) in _FIXTURE_TYPES:
                 raise FixtureProgrammingError(
                     'Expected provided data to be already '
                     'resolved, found unexpected fixture instance %s' % value
                 )
 
-        try:
-            raise_if_unresolved(resolved_data)
-            return None
-        except UnresolvedFixtureError as e:
-            return e.args[0]
+            # push children in reverse to visit them in order
+            if isinstance(value, list):
+                stack.extend(reversed(value))
+            elif isinstance(value, dict):
+                stack.extend(reversed(list(value.values())))
+
+        return None
 
     def attempt_data_resolution(self):
         """Ensures that data resolution has already been attempted. Nuances:
@@ -214,6 +290,23 @@ class AbstractStorageFixture(ABC):
         pass
 
 
+@contextmanager
+def memoize_existing_objects():
+    """Memoizes ModelFixture.existing_object() within the block, used by the
+    batch API. The memo is discarded on exit: fixtures outlive transactions
+    and a memo filled in a rolled back transaction would be wrong."""
+    if _existing_objects_memo.get() is not None:
+        # nested, keep using the outer memo
+        yield
+        return
+
+    token = _existing_objects_memo.set({})
+    try:
+        yield
+    finally:
+        _existing_objects_memo.reset(token)
+
+
 def register_field_resolver(field_name):
     """Decorator for registering custom field resolvers in any fixture class."""
     def decorator(fn):
@@ -226,6 +319,11 @@ def register_field_resolver(field_name):
 class ModelFixture(AbstractStorageFixture):
     model = None
     identifying_fields = []
+    # If True, the batch API may check existence of and create fixtures of
+    # this class in bulk, see prepop.batch.{load,unload}_fixtures(). This
+    # bypasses model.save() and its signals, and leaves uniqueness checks to
+    # the db.
+    bulk_loadable = False
 
     def __str__(self):
         return '{cls}({fields})'.format(
@@ -241,7 +339,38 @@ class ModelFixture(AbstractStorageFixture):
         model fixtures. A common scenario to support is when *some* of a
         fixture's data is not resolvable but its identifying fields are
         resolvable. In such cases, if we insist on self.resolvable, we "won't
-        see" that the fixture exists in db."""
+        see" that the fixture exists in db.
+
+        Within memoize_existing_objects(), i.e. during a batch, the result is
+        memoized since this is called repeatedly (by exists(), delete(), and
+        every dependent fixture's resolve_self()). create() and delete() keep
+        the memoized value up to date."""
+        memo = _existing_objects_memo.get()
+        if memo is None:
+            return self._lookup_existing_object()
+
+        obj = memo.get(self, _SENTINEL)
+        if obj is _SENTINEL or (obj is not None and obj.pk is None):
+            # a memoized object without pk has been deleted in the meantime,
+            # e.g. by another fixture of the same object sharing it.
+            obj = memo[self] = self._lookup_existing_object()
+
+        return obj
+
+    def _set_existing_object(self, obj):
+        # memoizes obj (or None) as the result of existing_object(), for use
+        # by code that has created, deleted, or looked up the object itself.
+        memo = _existing_objects_memo.get()
+        if memo is not None:
+            memo[self] = obj
+
+    def _forget_existing_object(self):
+        # makes the next existing_object() look the object up again.
+        memo = _existing_objects_memo.get()
+        if memo is not None:
+            memo.pop(self, None)
+
+    def _lookup_existing_object(self):
         model_kw = {k: self.resolved_data[k] for k in self.identifying_fields}
 
         if self.find_unresolvable_dependency(model_kw):
@@ -256,13 +385,13 @@ class ModelFixture(AbstractStorageFixture):
         return self.existing_object() is not None
 
     def create(self):
-        model_kw = self.resolved_data.copy()
+        resolved = self.resolved_data
 
-        # collect m2m fields and remove them from model_kw, to be set later
-        m2ms = {}
-        for key in list(model_kw.keys()):
-            if self.model._meta.get_field(key).many_to_many:
-                m2ms[key] = model_kw.pop(key)
+        # separate m2m fields from model_kw, to be set later
+        m2m_names = type(self)._m2m_field_names()
+        # copy nested values, model code may modify them in place
+        model_kw = {k: copy_tree(v) for k, v in resolved.items() if k not in m2m_names}
+        m2ms = {k: resolved[k] for k in m2m_names if k in resolved}
 
         obj = self.model(**model_kw)
 
@@ -277,8 +406,37 @@ class ModelFixture(AbstractStorageFixture):
             obj.full_clean()
             obj.save()
 
+        self._set_existing_object(obj)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _m2m_field_names(cls):
+        # model fields do not change at runtime, look them up once per class.
+        return frozenset(f.name for f in cls.model._meta.get_fields() if f.many_to_many)
+
     def delete(self):
-        self.existing_object().delete()
+        result = self.existing_object().delete()
+        self._set_existing_object(None)
+
+        memo = _existing_objects_memo.get()
+        if not memo:
+            return
+
+        # objects of other fixtures may have been deleted by cascade, forget
+        # the memoized objects of affected models. Models that override
+        # delete() may not return Django's deletion counts, in which case we
+        # forget all of them.
+        if isinstance(result, tuple) and len(result) == 2 and isinstance(result[1], dict):
+            label = self.model._meta.label
+            cascaded = {k for k, n in result[1].items() if n > (1 if k == label else 0)}
+        else:
+            cascaded = None
+
+        for fixture in list(memo):
+            if fixture is self:
+                continue
+            if cascaded is None or fixture.model._meta.label in cascaded:
+                del memo[fixture]
 
     def resolve_self(self):
         return self.existing_object() or UnresolvableFixture(self)
@@ -11,6 +11,10 @@ of nested lists and dictionaries. Example usage:
 
     resolve_department_addresses(data)
     #=> {"staff": [{"id": 12, "name": "John", "department": "45 Elm St. West"}]}
+
+Lists and dicts are only rebuilt if some value below them is replaced, subtrees
+that are left unchanged are returned as is (not copied). Use copy_tree() where
+the result may be modified in place.
 """
 
 
@@ -24,11 +28,40 @@ def walks_on_trees(fn):
         out = fn(value)
         if isinstance(out, TraversalTerminator):
             return out.value
+
+        # containers are only copied once a child has been replaced
         if isinstance(value, list):
-            return [wrapper(v) for v in value]
+            new = None
+            for i, v in enumerate(value):
+                w = wrapper(v)
+                if new is not None:
+                    new.append(w)
+                elif w is not v:
+                    new = value[:i]
+                    new.append(w)
+            return value if new is None else new
         if isinstance(value, dict):
-            return {k: wrapper(v) for k, v in value.items()}
+            new = None
+            for k, v in value.items():
+                w = wrapper(v)
+                if new is not None:
+                    new[k] = w
+                elif w is not v:
+                    new = dict(value)
+                    new[k] = w
+            return value if new is None else new
 
         return value
 
     return wrapper
+
+
+def copy_tree(value):
+    """Returns a copy of value in which all nested lists and dicts are copied,
+    other values are shared with value."""
+    if isinstance(value, list):
+        return [copy_tree(v) for v in value]
+    if isinstance(value, dict):
+        return {k: copy_tree(v) for k, v in value.items()}
+
+    return value
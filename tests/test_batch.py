@@ -0,0 +1,160 @@
+"""Tests for prepop.batch, run against an in-memory sqlite database."""
+import unittest
+
+import django
+from django.conf import settings
+
+if not settings.configured:
+    settings.configure(
+        INSTALLED_APPS=['django.contrib.contenttypes', 'prepop'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    )
+    django.setup()
+
+from django.db import connection, models, transaction  # noqa: E402
+
+from prepop.batch import load_fixtures, unload_fixtures  # noqa: E402
+from prepop.core import ModelFixture  # noqa: E402
+
+
+class Publisher(models.Model):
+    code = models.CharField(max_length=10, unique=True)
+
+    class Meta:
+        app_label = 'prepop'
+
+
+class Magazine(models.Model):
+    title = models.CharField(max_length=20)
+    publisher = models.ForeignKey(Publisher, to_field='code', on_delete=models.CASCADE)
+
+    class Meta:
+        app_label = 'prepop'
+
+
+class City(models.Model):
+    name = models.CharField(max_length=20, unique=True, db_collation='NOCASE')
+
+    class Meta:
+        app_label = 'prepop'
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=20)
+
+    class Meta:
+        app_label = 'prepop'
+
+    def delete(self, *args, **kwargs):
+        # does not return the deletion counts of Model.delete()
+        super().delete(*args, **kwargs)
+
+
+class Place(models.Model):
+    name = models.CharField(max_length=20)
+
+    class Meta:
+        app_label = 'prepop'
+
+
+class Restaurant(Place):
+    class Meta:
+        app_label = 'prepop'
+
+
+class PublisherFixture(ModelFixture):
+    model = Publisher
+    identifying_fields = ['code']
+    bulk_loadable = True
+
+
+class MagazineFixture(ModelFixture):
+    model = Magazine
+    identifying_fields = ['title', 'publisher']
+    bulk_loadable = True
+
+
+class CityFixture(ModelFixture):
+    model = City
+    identifying_fields = ['name']
+    bulk_loadable = True
+
+
+class TagFixture(ModelFixture):
+    model = Tag
+    identifying_fields = ['name']
+
+
+class RestaurantFixture(ModelFixture):
+    model = Restaurant
+    identifying_fields = ['name']
+    bulk_loadable = True
+
+
+def setUpModule():
+    with connection.schema_editor() as editor:
+        for model in (Publisher, Magazine, City, Tag, Place, Restaurant):
+            editor.create_model(model)
+
+
+class BatchTestCase(unittest.TestCase):
+    """Runs each test in a transaction that is rolled back afterwards."""
+    def setUp(self):
+        self.atomic = transaction.atomic()
+        self.atomic.__enter__()
+
+    def tearDown(self):
+        transaction.set_rollback(True)
+        self.atomic.__exit__(None, None, None)
+
+
+class BulkLoadTest(BatchTestCase):
+    def test_reload_with_fk_to_non_pk_field(self):
+        # Publisher's pk and its code differ, only the latter is stored in
+        # Magazine.publisher.
+        Publisher.objects.create(code='unused')
+
+        def batch():
+            publisher = PublisherFixture(code='abc')
+            return [publisher, MagazineFixture(title='Weekly', publisher=publisher)]
+
+        self.assertEqual(load_fixtures(batch()), 0)
+        self.assertEqual(load_fixtures(batch()), 0)
+
+        self.assertEqual(Magazine.objects.count(), 1)
+        self.assertTrue(MagazineFixture(title='Weekly', publisher=PublisherFixture(code='abc')).exists())
+
+    def test_existence_follows_db_collation(self):
+        City.objects.create(name='Foo')
+
+        self.assertEqual(load_fixtures([CityFixture(name='foo'), CityFixture(name='Bar')]), 0)
+
+        self.assertEqual(sorted(City.objects.values_list('name', flat=True)), ['Bar', 'Foo'])
+
+    def test_multi_table_inheritance(self):
+        self.assertEqual(load_fixtures([RestaurantFixture(name='Diner')]), 0)
+
+        self.assertTrue(Restaurant.objects.filter(name='Diner').exists())
+
+
+
+class BulkUnloadTest(BatchTestCase):
+    def test_existence_follows_db_collation(self):
+        City.objects.create(name='Foo')
+
+        self.assertEqual(unload_fixtures([CityFixture(name='foo')]), 0)
+
+        self.assertFalse(City.objects.exists())
+
+    def test_model_delete_without_return_value(self):
+        Tag.objects.create(name='news')
+        Tag.objects.create(name='sports')
+
+        self.assertEqual(unload_fixtures([TagFixture(name='news')]), 0)
+        TagFixture(name='sports').unload()
+
+        self.assertFalse(Tag.objects.exists())
+
+
+if __name__ == '__main__':
+    unittest.main()